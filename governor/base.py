@@ -2,6 +2,7 @@
 #
 # (c) 2020 Canonical Ltd. All right reservered
 #
+import hashlib
 import os
 import subprocess
 import yaml
@@ -11,11 +12,19 @@ from time import sleep
 
 from governor.juju_wrapper import JujuConnection
 from ops.charm import CharmBase
-from ops.model import BlockedStatus
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
 from ops.framework import StoredState, Object
 from governor.storage import GovernorStorage
 from governor.events import GovernorEvents
 
+BROKER_SNAP = "governor-broker"
+BROKER_SNAP_DIR = "/snap/governor-broker/current"
+BROKER_COMMON_DIR = "/var/snap/governor-broker/common"
+BROKER_INSTALL_CMD = ["snap", "install", BROKER_SNAP]
+BROKER_INSTALL_LOG = "install.log"
+BROKER_INSTALL_STATUS = "Installing governor-broker"
+BROKER_INSTALL_RETRIES = 3
+
 
 class GovernorEventHandler(Object):
     """
@@ -28,11 +37,19 @@ class GovernorEventHandler(Object):
     def __init__(self, charm, name):
         super().__init__(charm, name)
         self.events = charm.on
-        self.storage = GovernorStorage("/var/snap/governor-broker/common/gs_db")
+        self._storage = None
         self.framework.observe(
             self.events.governor_event_action, self.on_governor_event_action
         )
 
+    @property
+    def storage(self):
+        """ Open Governor Storage on first use, only hooks reading events need it. """
+        if self._storage is None:
+            os.makedirs(BROKER_COMMON_DIR, exist_ok=True)
+            self._storage = GovernorStorage(os.path.join(BROKER_COMMON_DIR, "gs_db"))
+        return self._storage
+
     def on_governor_event_action(self, event):
         """ React to action and start Processing Governor Events. """
         self.process_governor_events(event)
@@ -85,16 +102,22 @@ class GovernorBase(CharmBase):
     def __init__(self, *args):
         super().__init__(*args)
 
-        if not os.path.isdir("/var/snap/governor-broker/common"):
-            os.makedirs("/var/snap/governor-broker/common")
-
         self.governor_events = GovernorEventHandler(self, "governor_events")
 
         model_name = self.model.name
         if model_name is None:
             raise Exception("Failed to find model {}".format(model_name))
 
-        self.state.set_default(model_name=model_name)
+        self.state.set_default(
+            model_name=model_name,
+            creds_hash=None,
+            broker_install_pid=None,
+            broker_install_attempts=0,
+        )
+
+        self.framework.observe(self.on.update_status, self.on_update_status)
+        self.framework.observe(self.on.config_changed, self.on_reset_governord_install)
+        self.framework.observe(self.on.upgrade_charm, self.on_reset_governord_install)
 
         if self.creds_available():
             self.juju = JujuConnection(
@@ -109,23 +132,152 @@ class GovernorBase(CharmBase):
                 'Missing Juju controller configuration')
             self.juju = None
 
+    def on_update_status(self, event):
+        """ Check on a Governor Broker install started by start_governord. """
+        if self.state.broker_install_pid is not None or (
+            self.state.broker_install_attempts > 0
+        ):
+            self.install_governord()
+
+    def on_reset_governord_install(self, event):
+        """ Give a failed Governor Broker install a fresh set of retries. """
+        if self.state.broker_install_pid is None and (
+            self.state.broker_install_attempts > 0
+        ):
+            self.state.broker_install_attempts = 0
+            self.install_governord()
+
     def start_governord(self):
-        """ Create creds.yaml and starting Governor Broker. """
-        model_name = self.state.model_name
+        """
+        Bootstrap Governor Broker.
+
+        Safe to call from every hook: creds.yaml is only rewritten when its
+        content changed, queued events in gs_db are preserved and the snap is
+        installed in the background when it is not installed yet. The install
+        is checked again on update-status.
+        """
+        os.makedirs(BROKER_COMMON_DIR, exist_ok=True)
+        self.write_creds()
+        self.setup_storage()
+        self.install_governord()
+
+    def write_creds(self):
+        """ Write creds.yaml if its content changed, return True if written. """
         creds = {
             "endpoint": self.model.config["juju_controller_address"],
             "username": self.model.config["juju_controller_user"],
             "password": self.model.config["juju_controller_password"],
             "cacert": self.model.config["juju_controller_cacert"],
-            "model": model_name,
+            "model": self.state.model_name,
             "governor-charm": self.model.app.name,
         }
-        with open("/var/snap/governor-broker/common/creds.yaml", "w") as creds_file:
-            creds_file.write(yaml.dump(creds))
+        content = yaml.dump(creds).encode()
+        creds_hash = hashlib.sha256(content).hexdigest()
+        creds_path = os.path.join(BROKER_COMMON_DIR, "creds.yaml")
 
-        open("/var/snap/governor-broker/common/gs_db", "w").close()
+        if creds_hash == self.state.creds_hash and os.path.isfile(creds_path):
+            return False
 
-        subprocess.run(["snap", "install", "governor-broker"], check=True)
+        # Write to a temporary file first so the broker never reads partial creds.
+        tmp_path = creds_path + ".tmp"
+        with open(tmp_path, "wb") as creds_file:
+            creds_file.write(content)
+        os.replace(tmp_path, creds_path)
+        self.state.creds_hash = creds_hash
+        return True
+
+    def setup_storage(self):
+        """ Create gs_db or migrate an empty one, keeping queued events. """
+        db_path = os.path.join(BROKER_COMMON_DIR, "gs_db")
+
+        if os.path.isfile(db_path) and os.path.getsize(db_path) > 0:
+            return
+
+        # Older bootstraps left an empty gs_db behind, GovernorStorage creates
+        # the governor table in both cases.
+        GovernorStorage(db_path).close()
+
+    def governord_installed(self):
+        """ Check if Governor Broker snap is installed. """
+        return os.path.isdir(BROKER_SNAP_DIR)
+
+    def install_governord(self):
+        """
+        Install Governor Broker snap in the background and report status.
+
+        Output of snap install goes to install.log in the broker common
+        directory. A failed install blocks the unit and is retried on the
+        next call, up to BROKER_INSTALL_RETRIES attempts. The attempts are
+        reset on config-changed and upgrade-charm.
+        """
+        pid = self.state.broker_install_pid
+
+        if self.governord_installed():
+            self.state.broker_install_pid = None
+            self.state.broker_install_attempts = 0
+            if self._broker_status_set():
+                self._set_broker_status(ActiveStatus())
+            return
+
+        if pid is not None:
+            if _install_running(pid):
+                self._set_broker_status(MaintenanceStatus(BROKER_INSTALL_STATUS))
+                return
+
+            self.state.broker_install_pid = None
+            reason = self._install_failure_reason()
+            logging.warning("Installing %s failed: %s", BROKER_SNAP, reason)
+            self._set_broker_status(
+                BlockedStatus("Failed to install {}: {}".format(BROKER_SNAP, reason))
+            )
+            return
+
+        if self.state.broker_install_attempts >= BROKER_INSTALL_RETRIES:
+            logging.warning(
+                "Not installing %s, %d attempts failed. Retrying on config-changed "
+                "or upgrade-charm.",
+                BROKER_SNAP,
+                self.state.broker_install_attempts,
+            )
+            return
+
+        os.makedirs(BROKER_COMMON_DIR, exist_ok=True)
+        log_path = os.path.join(BROKER_COMMON_DIR, BROKER_INSTALL_LOG)
+        with open(log_path, "w") as log_file:
+            process = subprocess.Popen(
+                BROKER_INSTALL_CMD,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+        self.state.broker_install_pid = process.pid
+        self.state.broker_install_attempts += 1
+        self._set_broker_status(MaintenanceStatus(BROKER_INSTALL_STATUS))
+
+    def _install_failure_reason(self):
+        """ Return the last line of install.log. """
+        log_path = os.path.join(BROKER_COMMON_DIR, BROKER_INSTALL_LOG)
+        try:
+            with open(log_path) as log_file:
+                lines = [line.strip() for line in log_file if line.strip()]
+        except FileNotFoundError:
+            lines = []
+
+        return lines[-1] if lines else "see {}".format(log_path)
+
+    def _broker_status_set(self):
+        """ Check if the unit status was set by install_governord. """
+        status = self.model.unit.status
+        if isinstance(status, MaintenanceStatus):
+            return status.message == BROKER_INSTALL_STATUS
+        if isinstance(status, BlockedStatus):
+            return status.message.startswith("Failed to install {}".format(BROKER_SNAP))
+        return False
+
+    def _set_broker_status(self, status):
+        """ Set broker status unless Juju controller configuration is missing. """
+        if self.creds_available():
+            self.model.unit.status = status
 
     def creds_available(self):
         """ Check if Juju credentials are available. """
@@ -137,3 +289,14 @@ class GovernorBase(CharmBase):
         return not (
             len(addr) == 0 or len(user) == 0 or len(password) == 0 or len(cacert) == 0
         )
+
+
+def _install_running(pid):
+    """ Check if pid is still our snap install, not a reused pid. """
+    try:
+        with open("/proc/{}/cmdline".format(pid), "rb") as cmdline_file:
+            cmdline = cmdline_file.read()
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return False
+
+    return cmdline.split(b"\0")[:-1] == [arg.encode() for arg in BROKER_INSTALL_CMD]
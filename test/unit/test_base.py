@@ -1,10 +1,21 @@
+import os
+import subprocess
 from unittest import mock
 import pytest
+import yaml
 
 from ops.testing import Harness
-from ops.model import MaintenanceStatus, BlockedStatus
+from ops.model import ActiveStatus, MaintenanceStatus, BlockedStatus
 
-from governor.base import GovernorBase
+from governor.base import GovernorBase, _install_running
+from governor.storage import GovernorStorage
+
+CONFIG = {
+    "juju_controller_address": "address",
+    "juju_controller_user": "user",
+    "juju_controller_password": "password",
+    "juju_controller_cacert": "cacert",
+}
 
 
 @pytest.fixture
@@ -18,35 +29,221 @@ def harness():
     )
 
 
-def test_base_blocked(harness):
-    mkdir_patcher = mock.patch("os.makedirs")
-    storage_patcher = mock.patch("sqlite3.connect")
-    mkdir_patcher.start()
-    storage_patcher.start()
+@mock.patch("sqlite3.connect")
+@mock.patch("os.makedirs")
+def test_base_blocked(mock_makedirs, mock_connect, harness):
     harness.set_leader(True)
     harness.set_model_name("test")
     harness.begin_with_initial_hooks()
     assert isinstance(harness.charm.model.unit.status, BlockedStatus)
-    storage_patcher.stop()
 
 
+@mock.patch("sqlite3.connect")
+@mock.patch("os.makedirs")
 @mock.patch("governor.juju_wrapper.JujuConnection.__init__")
-def test_base(mock_juju_connection, harness):
-    mkdir_patcher = mock.patch("os.makedirs")
-    storage_patcher = mock.patch("sqlite3.connect")
-    mkdir_patcher.start()
-    storage_patcher.start()
+def test_base(mock_juju_connection, mock_makedirs, mock_connect, harness):
     mock_juju_connection.return_value = None
 
     harness.set_leader(True)
     harness.set_model_name("test")
-    harness.update_config(
-        {
-            "juju_controller_address": "address",
-            "juju_controller_user": "user",
-            "juju_controller_password": "password",
-            "juju_controller_cacert": "cacert",
-        }
-    )
+    harness.update_config(CONFIG)
     harness.begin_with_initial_hooks()
     assert isinstance(harness.charm.model.unit.status, MaintenanceStatus)
+
+
+@pytest.fixture
+def broker_dirs(tmp_path):
+    common_dir = tmp_path / "common"
+    snap_dir = tmp_path / "snap"
+    with mock.patch("governor.base.BROKER_COMMON_DIR", str(common_dir)), mock.patch(
+        "governor.base.BROKER_SNAP_DIR", str(snap_dir)
+    ):
+        yield common_dir, snap_dir
+
+
+@pytest.fixture
+def charm(harness, broker_dirs):
+    with mock.patch("governor.juju_wrapper.JujuConnection.__init__") as mock_juju:
+        mock_juju.return_value = None
+        harness.set_model_name("test")
+        harness.update_config(CONFIG)
+        harness.begin()
+        yield harness.charm
+
+
+@mock.patch("subprocess.Popen")
+def test_start_governord_idempotent(mock_popen, charm, broker_dirs):
+    common_dir, snap_dir = broker_dirs
+    mock_popen.return_value.pid = 1234
+
+    with mock.patch("governor.base._install_running", return_value=True):
+        charm.start_governord()
+        mock_popen.assert_called_once_with(
+            ["snap", "install", "governor-broker"],
+            stdout=mock.ANY,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+        assert charm.model.unit.status == MaintenanceStatus(
+            "Installing governor-broker"
+        )
+
+        # A running install is not started twice.
+        charm.start_governord()
+        assert mock_popen.call_count == 1
+
+    creds = yaml.safe_load((common_dir / "creds.yaml").read_text())
+    assert creds["endpoint"] == "address"
+    assert creds["model"] == "test"
+
+    # Queued events survive later bootstraps.
+    storage = GovernorStorage(str(common_dir / "gs_db"))
+    storage.write_event_data({"event_name": "unit_added"})
+    storage.close()
+
+    snap_dir.mkdir()
+    charm.on.update_status.emit()
+    assert mock_popen.call_count == 1
+    assert isinstance(charm.model.unit.status, ActiveStatus)
+    assert charm.state.broker_install_pid is None
+    assert not charm.write_creds()
+
+    storage = GovernorStorage(str(common_dir / "gs_db"))
+    assert storage.read_all_event_data() == [{"event_name": "unit_added"}]
+    storage.close()
+
+
+@mock.patch("subprocess.Popen")
+def test_install_governord_failed(mock_popen, charm, broker_dirs):
+    common_dir, _ = broker_dirs
+    mock_popen.return_value.pid = 1234
+
+    charm.start_governord()
+    (common_dir / "install.log").write_text("error: snap not found\n")
+
+    # The install process exited without installing the snap.
+    with mock.patch("governor.base._install_running", return_value=False):
+        charm.on.update_status.emit()
+    assert charm.model.unit.status == BlockedStatus(
+        "Failed to install governor-broker: error: snap not found"
+    )
+    assert charm.state.broker_install_pid is None
+
+    # The next hook retries, until the retries are used up.
+    charm.on.update_status.emit()
+    assert mock_popen.call_count == 2
+    assert isinstance(charm.model.unit.status, MaintenanceStatus)
+
+    with mock.patch("governor.base._install_running", return_value=False):
+        for _ in range(4):
+            charm.on.update_status.emit()
+    assert mock_popen.call_count == 3
+    assert isinstance(charm.model.unit.status, BlockedStatus)
+    assert charm.state.broker_install_pid is None
+
+    # config-changed gives the install a fresh set of retries.
+    charm.on.config_changed.emit()
+    assert mock_popen.call_count == 4
+    assert charm.state.broker_install_attempts == 1
+    assert isinstance(charm.model.unit.status, MaintenanceStatus)
+
+
+@mock.patch("subprocess.Popen")
+def test_install_governord_installed_after_failure(mock_popen, charm, broker_dirs):
+    _, snap_dir = broker_dirs
+    mock_popen.return_value.pid = 1234
+
+    charm.start_governord()
+    with mock.patch("governor.base._install_running", return_value=False):
+        for _ in range(6):
+            charm.on.update_status.emit()
+    assert mock_popen.call_count == 3
+    assert isinstance(charm.model.unit.status, BlockedStatus)
+
+    # The snap was installed by hand after the retries were used up.
+    snap_dir.mkdir()
+    charm.on.update_status.emit()
+    assert isinstance(charm.model.unit.status, ActiveStatus)
+    assert charm.state.broker_install_attempts == 0
+
+
+@mock.patch("subprocess.Popen")
+def test_install_governord_stale_pid(mock_popen, charm):
+    mock_popen.return_value.pid = 1234
+    # Pid left behind by an install before a reboot, now used by this process.
+    charm.state.broker_install_pid = os.getpid()
+
+    charm.start_governord()
+    assert isinstance(charm.model.unit.status, BlockedStatus)
+    mock_popen.assert_not_called()
+
+    charm.start_governord()
+    mock_popen.assert_called_once()
+    assert charm.state.broker_install_pid == 1234
+
+
+@mock.patch("subprocess.Popen")
+def test_install_governord_keeps_blocked(mock_popen, harness, broker_dirs):
+    mock_popen.return_value.pid = 1234
+    harness.set_model_name("test")
+    harness.begin()
+
+    harness.charm.install_governord()
+    mock_popen.assert_called_once()
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "Missing Juju controller configuration"
+    )
+
+
+def test_install_running():
+    with open("/proc/self/cmdline") as cmdline_file:
+        cmdline = cmdline_file.read().split("\0")[:-1]
+
+    assert not _install_running(os.getpid())
+    with mock.patch("governor.base.BROKER_INSTALL_CMD", cmdline):
+        assert _install_running(os.getpid())
+
+    process = subprocess.Popen(["true"])
+    process.wait()
+    with mock.patch("governor.base.BROKER_INSTALL_CMD", ["true"]):
+        assert not _install_running(process.pid)
+
+
+def test_write_creds_on_change(charm, broker_dirs, harness):
+    common_dir, _ = broker_dirs
+    common_dir.mkdir()
+
+    assert charm.write_creds()
+    assert not charm.write_creds()
+
+    harness.update_config({"juju_controller_address": "new-address"})
+    assert charm.write_creds()
+    creds = yaml.safe_load((common_dir / "creds.yaml").read_text())
+    assert creds["endpoint"] == "new-address"
+
+    # A removed creds.yaml is written again.
+    (common_dir / "creds.yaml").unlink()
+    assert charm.write_creds()
+
+
+def test_setup_storage_migrates_empty_db(harness, broker_dirs):
+    common_dir, _ = broker_dirs
+    common_dir.mkdir()
+    (common_dir / "gs_db").touch()
+
+    harness.set_model_name("test")
+    harness.begin()
+    harness.charm.setup_storage()
+
+    storage = GovernorStorage(str(common_dir / "gs_db"))
+    assert storage.read_all_event_data() == []
+    storage.close()
+
+
+def test_storage_creates_common_dir(harness, broker_dirs):
+    common_dir, _ = broker_dirs
+
+    harness.set_model_name("test")
+    harness.begin()
+    harness.charm.governor_events.storage.close()
+    assert (common_dir / "gs_db").is_file()